@@ -1,2 +1,2 @@
 #!/bin/sh
-python main.py
\ No newline at end of file
+exec gunicorn -w 1 -k gthread --threads 16 -b "0.0.0.0:${PORT:-10424}" wsgi:application
\ No newline at end of file
@@ -1,469 +1,718 @@
 #!/usr/bin/env python3
+import atexit
+import gzip
 import os
 import yaml # type: ignore
 import subprocess
 import logging
 import json
 import shlex
+import struct
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, request, Response # type: ignore
-from prometheus_client import CollectorRegistry, Gauge, generate_latest # type: ignore
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, generate_latest # type: ignore
+from prometheus_client.core import GaugeMetricFamily # type: ignore
+
+# orjson is much faster on the large perccli documents; both accept bytes.
+try:
+    import orjson as _json # type: ignore
+except ImportError:
+    _json = json
 
 app = Flask("ESXi PERCCLI Exporter")
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
 
+# Prefer the LibYAML-backed loader when PyYAML was built with it.
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+_SMART_ATTR_NAMES = {
+    0x01: "raw_read_error_rate", 0x03: "spin_up_time", 0x04: "start_stop_count", 0x05: "reallocated_sector_count",
+    0x07: "seek_error_rate", 0x09: "power_on_hours", 0x0C: "power_cycle_count", 0x53: "initial_bad_block_count",
+    0xB1: "wear_leveling_count", 0xB3: "used_reserved_block_count_total", 0xB4: "unused_reserved_block_count_total",
+    0xB5: "program_fail_count_total", 0xB6: "erase_fail_count_total", 0xB7: "runtime_bad_block", 0xB8: "end_to_end_error",
+    0xBB: "uncorrectable_error_count", 0xBE: "airflow_temperature_celsius", 0xC2: "temperature_celsius", 0xC3: "hardware_ecc_recovered",
+    0xC5: "current_pending_sector_count", 0xC6: "uncorrectable_sector_count", 0xC7: "udma_crc_error_count", 0xCA: "data_address_mark_errors",
+    0xEB: "por_recovery_count", 0xF1: "total_host_writes", 0xF2: "total_host_reads", 0xF3: "total_host_writes_expanded",
+    0xF4: "total_host_reads_expanded", 0xF5: "remaining_rated_write_endurance", 0xF6: "cumulative_host_sectors_written",
+    0xF7: "host_program_page_count", 0xFB: "minimum_spares_remaining",
+}
+# One 12-byte SMART attribute entry: id, flags (2), normalized, worst, raw (6), reserved.
+_SMART_ENTRY = struct.Struct("<B4x6sx")
+# The attribute table has 30 entries; what follows it (offline collection status,
+# self-test data, vendor bytes) is not attribute data.
+_SMART_TABLE_SIZE = 30 * _SMART_ENTRY.size
+# Known revisions (little-endian 0x0001, 0x002F) of the 2-byte header that
+# precedes the attribute table.
+_SMART_HEADER_VERSIONS = frozenset({b"\x01\x00", b"\x2f\x00"})
+# Attribute id -> name for every possible id, including the unknown_xx fallbacks.
+_SMART_ATTR_LABELS: tuple[str, ...] = tuple(_SMART_ATTR_NAMES.get(i, f"unknown_{i:02x}") for i in range(256))
+# Every byte that is not a hex digit, for bytes.translate to delete.
+_NON_HEX_BYTES = bytes(c for c in range(256) if chr(c) not in "0123456789abcdefABCDEF")
+# "Smart Data Info /cX/eY/sZ = " followed by lines of hex bytes.
+_SMART_BLOCK_RE = re.compile(r'Smart Data Info \S+ = \n((?:[0-9a-fA-F ]+(?:\n|\Z))+)')
+# Printed after each command of a batched remote invocation.
+_BATCH_SENTINEL = "===PERCCLI-END==="
+# Sentinel line of a batched smartctl run, carrying the command's exit status.
+_SMARTCTL_STATUS_RE = re.compile(rb"%s (\d+)\n" % _BATCH_SENTINEL.encode())
+# smartctl exit status bits 0 (command line did not parse) and 1 (device open
+# failed): the JSON then holds no device data.
+_SMARTCTL_FATAL_BITS = 0b11
+_WS_TABLE = str.maketrans('', '', ' \n\r\t')
+# smartctl NVMe health log key -> metric name. percentage_used is exported
+# inverted, as the life left.
+_NVME_ATTR_MAP = {
+    "critical_warning": "critical_warning",
+    "temperature": "temperature_celsius",
+    "available_spare": "available_spare_percent",
+    "available_spare_threshold": "available_spare_threshold_percent",
+    "percentage_used": "ssd_life_left",
+    "data_units_read": "data_units_read",
+    "data_units_written": "data_units_written",
+    "host_reads": "host_reads",
+    "host_writes": "host_writes",
+    "controller_busy_time": "controller_busy_time_minutes",
+    "power_cycles": "power_cycles",
+    "power_on_hours": "power_on_hours",
+    "unsafe_shutdowns": "unsafe_shutdowns",
+    "media_errors": "media_errors",
+    "num_err_log_entries": "error_log_entries",
+    "warning_temp_time": "warning_temperature_time_minutes",
+    "critical_comp_time": "critical_composite_temperature_time_minutes",
+}
+# NVMe data units are thousands of 512-byte blocks.
+_NVME_UNITS_512K = frozenset({"data_units_read", "data_units_written"})
+# Per-operation counters of the SCSI error counter log, exported as <op>_<counter>.
+_SCSI_ERROR_COUNTERS = (
+    "errors_corrected_by_eccfast", "errors_corrected_by_eccdelayed", "errors_corrected_by_rereads_rewrites",
+    "total_errors_corrected", "correction_algorithm_invocations", "total_uncorrected_errors",
+)
+# smartctl -d device type -> parser used for it.
+_DEVICE_TYPES = {"nvme": "nvme", "scsi": "scsi", "megaraid": "scsi", "sat+megaraid": "scsi"}
+# One `smartctl --scan-open` line: device, -d argument, and the optional [id] in the comment.
+_SCAN_LINE_RE = re.compile(r'(/dev/\S+)\s+(-d\s+\S+(?:,\d+)?)\s*(?:#.*?\[(\S+)\])?')
+# The bracketed device id of a scan line comment, as _SCAN_LINE_RE captures it.
+_SCAN_ID_RE = re.compile(r'\[(\S+)\]')
+
+# Reuse one authenticated SSH connection per host for all commands of a scrape
+# (and of scrapes within the persist window) instead of handshaking every time.
+_SSH_MUX_OPTS = ["-o", "ControlMaster=auto", "-o", "ControlPath=/tmp/ssh-%r@%h:%p", "-o", "ControlPersist=60s"]
+# Upper bound for a single SSH invocation; batched SMART reads run several perccli calls.
+_SSH_TIMEOUT = 60
+
+# Reading SMART data makes the drives do real work, so it is refreshed far less
+# often than the controller state. Keyed by (host, drive path).
+_SMART_TTL = int(os.environ.get("SMART_TTL", "600"))
+_SMART_CACHE: dict[tuple[str, str], tuple[float, str]] = {}
+
+# Controller state changes on a scale of minutes, so back-to-back scrapes (or
+# several Prometheus servers) share one perccli JSON result per host for a while.
+_PERCCLI_TTL = int(os.environ.get("PERCCLI_TTL", "30"))
+_PERCCLI_CACHE: dict[tuple[str, tuple[str, ...]], tuple[float, dict]] = {}
+_PERCCLI_CACHE_LOCK = threading.Lock()
+
+# Duplicate scrapes of one target (HA Prometheus pairs, retries) within this many
+# seconds get the previously generated exposition instead of a fresh collection.
+_SCRAPE_TTL = int(os.environ.get("SCRAPE_TTL", "10"))
+
+class SmartCollector:
+    # Holds the SMART samples of the current scrape and yields one gauge family
+    # per attribute, megaraid_drive_smart_<attribute>{controller, drive}.
+    def __init__(self, namespace: str) -> None:
+        self.namespace = namespace
+        self.samples: dict[str, list[tuple[list[str], float]]] = {}
+
+    def add(self, attribute: str, controller: str, drive: str, value: float) -> None:
+        self.samples.setdefault(attribute, []).append(([str(controller), drive], value))
+
+    def clear(self) -> None:
+        self.samples = {}
+
+    def collect(self):
+        for attribute, samples in self.samples.items():
+            family = GaugeMetricFamily(
+                f"{self.namespace}_drive_smart_{attribute}",
+                f"Drive SMART attribute {attribute}",
+                labels=["controller", "drive"]
+            )
+            for labels, value in samples:
+                family.add_metric(labels, value)
+            yield family
+
+def _json_section(parent: dict, key: str) -> dict:
+    # smartctl JSON sections are objects; anything else is treated as absent.
+    value = parent.get(key)
+    return value if isinstance(value, dict) else {}
+
 class PercMetrics:
+    __slots__ = (
+        "registry", "username", "password", "host", "_ssh_prefix",
+        "_lock", "_last_output", "_skipped_drivers",
+        "controller_info", "controller_status", "controller_temperature",
+        "drive_status", "drive_temp", "virtual_drive_status", "bbu_health",
+        "smart", "_children", "_seen_children",
+    )
+    namespace = "megaraid"
+
     def __init__(self, username: str, password: str, host: str) -> None:
-        logger.debug(f"Initializing PercMetrics for host: {host}")
+        logger.debug("Initializing PercMetrics for host: %s", host)
         self.registry = CollectorRegistry()
-        self.namespace = "megaraid"
         self.username = username
         self.password = password
         self.host = host
-        self.metrics = {
-            "controller_info": Gauge(
-                f"{self.namespace}_controller_info",
-                "MegaRAID controller info",
-                ["controller", "model", "serial", "fwversion"],
-                registry=self.registry
-            ),
-            "controller_status": Gauge(
-                f"{self.namespace}_controller_status",
-                "Controller status (1=Optimal, 0=Not Optimal)",
-                ["controller"],
-                registry=self.registry
-            ),
-            "controller_temperature": Gauge(
-                f"{self.namespace}_controller_temperature",
-                "Controller temperature in Celsius",
-                ["controller"],
-                registry=self.registry
-            ),
-            "drive_status": Gauge(
-                f"{self.namespace}_drive_status",
-                "Physical drive status (1=Online, 0=Other)",
-                ["controller", "drive"],
-                registry=self.registry
-            ),
-            "drive_temp": Gauge(
-                f"{self.namespace}_drive_temp",
-                "Physical drive temperature in Celsius",
-                ["controller", "drive"],
-                registry=self.registry
-            ),
-            "drive_smart": Gauge(
-                f"{self.namespace}_drive_smart",
-                "Drive SMART attributes",
-                ["controller", "drive", "attribute"],
-                registry=self.registry
-            ),
-            "virtual_drive_status": Gauge(
-                f"{self.namespace}_virtual_drive_status",
-                "Virtual drive status (1=Optimal, 0=Other)",
-                ["controller", "vd"],
-                registry=self.registry
-            ),
-            "bbu_health": Gauge(
-                f"{self.namespace}_bbu_health",
-                "Battery Backup Unit health (1=Healthy, 0=Unhealthy)",
-                ["controller"],
-                registry=self.registry
-            ),
-        }
-
-    def parse_smart_data(self, smart_data_hex: str) -> dict:
-        attributes = {}
+        # Everything but the remote command is fixed for the lifetime of the instance.
+        self._ssh_prefix = [
+            "ssh", "-i", "/root/.ssh/id_rsa_exporter", "-p", "22",
+            "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", *_SSH_MUX_OPTS,
+            f"{username}@{host}",
+        ]
+        self._lock = threading.Lock()
+        self._last_output: tuple[float, bytes] | None = None
+        # Controller drivers without a handler, so they are only logged once.
+        self._skipped_drivers: set[str] = set()
+        self.controller_info = Gauge(
+            f"{self.namespace}_controller_info",
+            "MegaRAID controller info",
+            ["controller", "model", "serial", "fwversion"],
+            registry=self.registry
+        )
+        self.controller_status = Gauge(
+            f"{self.namespace}_controller_status",
+            "Controller status (1=Optimal, 0=Not Optimal)",
+            ["controller"],
+            registry=self.registry
+        )
+        self.controller_temperature = Gauge(
+            f"{self.namespace}_controller_temperature",
+            "Controller temperature in Celsius",
+            ["controller"],
+            registry=self.registry
+        )
+        self.drive_status = Gauge(
+            f"{self.namespace}_drive_status",
+            "Physical drive status (1=Online, 0=Other)",
+            ["controller", "drive"],
+            registry=self.registry
+        )
+        self.drive_temp = Gauge(
+            f"{self.namespace}_drive_temp",
+            "Physical drive temperature in Celsius",
+            ["controller", "drive"],
+            registry=self.registry
+        )
+        self.virtual_drive_status = Gauge(
+            f"{self.namespace}_virtual_drive_status",
+            "Virtual drive status (1=Optimal, 0=Other)",
+            ["controller", "vd"],
+            registry=self.registry
+        )
+        self.bbu_health = Gauge(
+            f"{self.namespace}_bbu_health",
+            "Battery Backup Unit health (1=Healthy, 0=Unhealthy)",
+            ["controller"],
+            registry=self.registry
+        )
+        # SMART attributes vary per drive and there are many of them, so they are
+        # exported by a custom collector rather than through Gauge children.
+        self.smart = SmartCollector(self.namespace)
+        self.registry.register(self.smart)
+        # Gauge children by (gauge, label values), kept across scrapes so labels()
+        # only runs for new series; the ones a scrape did not touch are swept.
+        self._children: dict[tuple[Gauge, tuple], Gauge] = {}
+        self._seen_children: set[tuple[Gauge, tuple]] = set()
+
+    def parse_smart_data(self, smart_data_hex: str) -> dict[str, int]:
+        attributes: dict[str, int] = {}
+        hex_clean = smart_data_hex.encode("ascii", "ignore").translate(None, _NON_HEX_BYTES).decode("ascii")
+        # A dangling nibble (truncated output) would make fromhex reject the whole blob.
+        if len(hex_clean) % 2:
+            hex_clean = hex_clean[:-1]
         try:
-            hex_clean = re.sub(r'[^0-9a-fA-F]', '', smart_data_hex)
-            byte_array = []
-            for i in range(0, len(hex_clean), 2):
-                byte_array.append(int(hex_clean[i:i+2], 16))
-            
-            start_index = 0
-            if len(byte_array) >= 2 and (byte_array[0] == 0x01 and byte_array[1] == 0x00) or (byte_array[0] == 0x2f and byte_array[1] == 0x00):
-                start_index = 2
-
-            i = start_index
-            while i + 10 < len(byte_array):
-                try:
-                    attr_id = byte_array[i]
-                    if not (1 <= attr_id <= 255):
-                        i += 1
-                        continue
-                    
-                    if i + 10 >= len(byte_array):
-                        logger.warning(f"Not enough bytes for attribute ID {attr_id} at index {i}. Breaking.")
-                        break
-
-                    normalized_value = byte_array[i+3]
-                    worst_value = byte_array[i+4]
-                    raw_value_bytes = byte_array[i+5 : i+11]
-                    raw_value = 0
-                    for k, byte_val in enumerate(raw_value_bytes):
-                        raw_value |= (byte_val << (k * 8))
-
-                    attr_name_map = {
-                        0x01: "raw_read_error_rate", 0x03: "spin_up_time", 0x04: "start_stop_count", 0x05: "reallocated_sector_count", 
-                        0x07: "seek_error_rate", 0x09: "power_on_hours", 0x0C: "power_cycle_count", 0x53: "initial_bad_block_count", 
-                        0xB1: "wear_leveling_count", 0xB3: "used_reserved_block_count_total", 0xB4: "unused_reserved_block_count_total", 
-                        0xB5: "program_fail_count_total", 0xB6: "erase_fail_count_total", 0xB7: "runtime_bad_block", 0xB8: "end_to_end_error",
-                        0xBB: "uncorrectable_error_count", 0xBE: "airflow_temperature_celsius", 0xC2: "temperature_celsius", 0xC3: "hardware_ecc_recovered",
-                        0xC5: "current_pending_sector_count", 0xC6: "uncorrectable_sector_count", 0xC7: "udma_crc_error_count", 0xCA: "data_address_mark_errors", 
-                        0xEB: "por_recovery_count", 0xF1: "total_host_writes", 0xF2: "total_host_reads", 0xF3: "total_host_writes_expanded", 
-                        0xF4: "total_host_reads_expanded", 0xF5: "remaining_rated_write_endurance", 0xF6: "cumulative_host_sectors_written", 
-                        0xF7: "host_program_page_count", 0xFB: "minimum_spares_remaining",
-                    }
-                    
-                    attr_name = attr_name_map.get(attr_id, f"unknown_{attr_id:02x}")
-                    attributes[attr_name] = raw_value_bytes[0] if attr_id == 0xC2 else raw_value
-                    i += 11
-                except (ValueError, IndexError) as e:
-                    logger.warning(f"Failed to parse 11-byte block at index {i}: {e}. Trying next byte.")
-                    i += 1
-        except Exception as e:
-            logger.error(f"Failed to process SMART data string: {e}", exc_info=True)
+            buf = bytes.fromhex(hex_clean)
+        except ValueError as e:
+            logger.error(f"Failed to process SMART data string: {e}")
             return {}
-        logger.debug(f"Parsed SMART attributes: {attributes}")
+
+        # Shorter buffers yield a shorter slice, which never matches.
+        start_index = 2 if buf[:2] in _SMART_HEADER_VERSIONS else 0
+
+        end_index = start_index + min(_SMART_TABLE_SIZE, (len(buf) - start_index) // _SMART_ENTRY.size * _SMART_ENTRY.size)
+        # Locals skip the global/attribute lookups on every entry.
+        labels, from_bytes = _SMART_ATTR_LABELS, int.from_bytes
+        for attr_id, raw_bytes in _SMART_ENTRY.iter_unpack(memoryview(buf)[start_index:end_index]):
+            if attr_id != 0:
+                attributes[labels[attr_id]] = raw_bytes[0] if attr_id == 0xC2 else from_bytes(raw_bytes, "little")
+        logger.debug("Parsed SMART attributes: %s", attributes)
         return attributes
 
-    def parse_smartctl_nvme(self, smartctl_cmd: str) -> tuple[dict, str]:
-        logger.debug(f"Entering parse_smartctl_nvme with command: {smartctl_cmd}")
+    def parse_smartctl_nvme(self, out: bytes) -> tuple[dict, str]:
+        logger.debug("Entering parse_smartctl_nvme.")
+        logger.debug("Raw smartctl output: %s...", out[:500])
         try:
-            out = self.run_remote_cmd(smartctl_cmd)
-            logger.debug(f"Raw smartctl output: {out[:500]}...")
-            data = json.loads(out)
-            attrs = {}
-            serial = data.get("serial_number", "unknown")
-            smart_log = data.get("nvme_smart_health_information_log", {})
-            
-            # Map SMART attributes to metric-friendly names
-            attribute_map = {
-                "critical_warning": "critical_warning",
-                "temperature": "temperature_celsius",
-                "available_spare": "available_spare_percent",
-                "available_spare_threshold": "available_spare_threshold_percent",
-                "percentage_used": "percentage_used",
-                "data_units_read": "data_units_read",
-                "data_units_written": "data_units_written",
-                "host_reads": "host_reads",
-                "host_writes": "host_writes",
-                "controller_busy_time": "controller_busy_time_minutes",
-                "power_cycles": "power_cycles",
-                "power_on_hours": "power_on_hours",
-                "unsafe_shutdowns": "unsafe_shutdowns",
-                "media_errors": "media_errors",
-                "num_err_log_entries": "error_log_entries",
-                "warning_temp_time": "warning_temperature_time_minutes",
-                "critical_comp_time": "critical_composite_temperature_time_minutes"
-            }
-            
-            for json_key, metric_name in attribute_map.items():
-                if json_key in smart_log:
-                    value = smart_log[json_key]
-                    if json_key in ["data_units_read", "data_units_written"]:
-                        value = value * 512 * 1000  # Convert to bytes
-                    if json_key == "percentage_used":
-                        metric_name = "ssd_life_left"
-                        value = 100 - value
-                    attrs[metric_name] = value
-            
-            # Handle temperature_sensors array
-            if "temperature_sensors" in smart_log:
-                for i, temp in enumerate(smart_log["temperature_sensors"]):
-                    attrs[f"temperature_sensor_{i+1}_celsius"] = temp
-
-            # Add additional attributes
-            if "nvme_total_capacity" in data:
-                attrs["total_capacity_bytes"] = data["nvme_total_capacity"]
-            if "smart_status" in data and "passed" in data["smart_status"]:
-                attrs["smart_status_passed"] = 1 if data["smart_status"]["passed"] else 0
-
-        except Exception as e:
-            logger.error(f"Error parsing NVMe smartctl output: {e}\nRaw output: {out[:1000]}", exc_info=True)
+            data = _json.loads(out)
+        except ValueError as e:
+            logger.error(f"Error parsing NVMe smartctl output: {e}\nRaw output: {out[:1000]!r}")
+            return {}, "unknown"
+        if not isinstance(data, dict):
+            logger.error(f"Unexpected NVMe smartctl output, not a JSON object: {out[:1000]!r}")
             return {}, "unknown"
+        attrs = {}
+        serial = data.get("serial_number", "unknown")
+        smart_log = _json_section(data, "nvme_smart_health_information_log")
+
+        for json_key, value in smart_log.items():
+            metric_name = _NVME_ATTR_MAP.get(json_key)
+            if metric_name is None:
+                continue
+            if json_key in _NVME_UNITS_512K:
+                value = value * 512 * 1000  # Convert to bytes
+            elif json_key == "percentage_used":
+                value = 100 - value
+            attrs[metric_name] = value
+
+        # Handle temperature_sensors array
+        for i, temp in enumerate(smart_log.get("temperature_sensors") or (), 1):
+            attrs[f"temperature_sensor_{i}_celsius"] = temp
+
+        # Add additional attributes
+        if "nvme_total_capacity" in data:
+            attrs["total_capacity_bytes"] = data["nvme_total_capacity"]
+        smart_status = _json_section(data, "smart_status")
+        if "passed" in smart_status:
+            attrs["smart_status_passed"] = 1 if smart_status["passed"] else 0
         return attrs, serial
 
-    def parse_smartctl_scsi(self, smartctl_cmd: str) -> tuple[dict, str]:
-        logger.debug(f"Entering parse_smartctl_scsi with command: {smartctl_cmd}")
+    def parse_smartctl_scsi(self, out: bytes) -> tuple[dict, str]:
+        logger.debug("Entering parse_smartctl_scsi.")
+        logger.debug("Raw smartctl output: %s...", out[:500])
         try:
-            out = self.run_remote_cmd(smartctl_cmd)
-            logger.debug(f"Raw smartctl output: {out[:500]}...")
-            data = json.loads(out)
-            attrs = {}
-            serial = data.get("serial_number", "unknown")
-
-            # Temperature
-            if "temperature" in data:
-                attrs["temperature_celsius"] = data["temperature"]["current"]
-
-            # Power-On Time
-            if "power_on_time" in data:
-                attrs["power_on_hours"] = data["power_on_time"]["hours"]
-
-            # Start-Stop and Load-Unload Cycles
-            if "scsi_start_stop_cycle_counter" in data:
-                cycle = data["scsi_start_stop_cycle_counter"]
-                attrs["specified_cycle_count_over_device_lifetime"] = cycle.get("specified_cycle_count_over_device_lifetime", 0)
-                attrs["accumulated_start_stop_cycles"] = cycle.get("accumulated_start_stop_cycles", 0)
-                attrs["specified_load_unload_count_over_device_lifetime"] = cycle.get("specified_load_unload_count_over_device_lifetime", 0)
-                attrs["accumulated_load_unload_cycles"] = cycle.get("accumulated_load_unload_cycles", 0)
-
-            # Grown Defect List
-            if "scsi_grown_defect_list" in data:
-                attrs["grown_defect_list"] = data["scsi_grown_defect_list"]
-
-            # Error Counter Log
-            if "scsi_error_counter_log" in data:
-                error_log = data["scsi_error_counter_log"]
-                for op in ["read", "write", "verify"]:
-                    if op in error_log:
-                        op_data = error_log[op]
-                        attrs[f"{op}_errors_corrected_by_eccfast"] = op_data.get("errors_corrected_by_eccfast", 0)
-                        attrs[f"{op}_errors_corrected_by_eccdelayed"] = op_data.get("errors_corrected_by_eccdelayed", 0)
-                        attrs[f"{op}_errors_corrected_by_rereads_rewrites"] = op_data.get("errors_corrected_by_rereads_rewrites", 0)
-                        attrs[f"{op}_total_errors_corrected"] = op_data.get("total_errors_corrected", 0)
-                        attrs[f"{op}_correction_algorithm_invocations"] = op_data.get("correction_algorithm_invocations", 0)
-                        attrs[f"{op}_gigabytes_processed"] = float(op_data.get("gigabytes_processed", "0"))
-                        attrs[f"{op}_total_uncorrected_errors"] = op_data.get("total_uncorrected_errors", 0)
-
-            # Pending Defects
-            if "scsi_pending_defects" in data:
-                attrs["pending_defects_count"] = data["scsi_pending_defects"]["count"]
-
-            # Self-Test Results
-            if "scsi_self_test_0" in data:
-                test_0 = data["scsi_self_test_0"]
-                attrs["self_test_0_result"] = test_0["result"]["value"]
-                attrs["self_test_0_power_on_time"] = test_0["power_on_time"]["hours"]
-
-            if "scsi_self_test_1" in data:
-                test_1 = data["scsi_self_test_1"]
-                attrs["self_test_1_result"] = test_1["result"]["value"]
-                attrs["self_test_1_power_on_time"] = test_1["power_on_time"]["hours"]
-
-            # Extended Self-Test Duration
-            if "scsi_extended_self_test_seconds" in data:
-                attrs["extended_self_test_seconds"] = data["scsi_extended_self_test_seconds"]
-
-            # SMART Status
-            if "smart_status" in data:
-                attrs["smart_status_passed"] = 1 if data["smart_status"]["passed"] else 0
-
-            logger.debug(f"Parsed SCSI SMART data: {attrs}, Serial: {serial}")
-        except Exception as e:
-            logger.error(f"Error parsing SCSI smartctl output: {e}\nRaw output: {out[:1000]}", exc_info=True)
+            data = _json.loads(out)
+        except ValueError as e:
+            logger.error(f"Error parsing SCSI smartctl output: {e}\nRaw output: {out[:1000]!r}")
             return {}, "unknown"
+        if not isinstance(data, dict):
+            logger.error(f"Unexpected SCSI smartctl output, not a JSON object: {out[:1000]!r}")
+            return {}, "unknown"
+        attrs = {}
+        serial = data.get("serial_number", "unknown")
+
+        # Temperature
+        temperature = _json_section(data, "temperature").get("current")
+        if temperature is not None:
+            attrs["temperature_celsius"] = temperature
+
+        # Power-On Time
+        power_on_hours = _json_section(data, "power_on_time").get("hours")
+        if power_on_hours is not None:
+            attrs["power_on_hours"] = power_on_hours
+
+        # Start-Stop and Load-Unload Cycles
+        cycle = data.get("scsi_start_stop_cycle_counter")
+        if isinstance(cycle, dict):
+            attrs["specified_cycle_count_over_device_lifetime"] = cycle.get("specified_cycle_count_over_device_lifetime", 0)
+            attrs["accumulated_start_stop_cycles"] = cycle.get("accumulated_start_stop_cycles", 0)
+            attrs["specified_load_unload_count_over_device_lifetime"] = cycle.get("specified_load_unload_count_over_device_lifetime", 0)
+            attrs["accumulated_load_unload_cycles"] = cycle.get("accumulated_load_unload_cycles", 0)
+
+        # Grown Defect List
+        if "scsi_grown_defect_list" in data:
+            attrs["grown_defect_list"] = data["scsi_grown_defect_list"]
+
+        # Error Counter Log
+        error_log = _json_section(data, "scsi_error_counter_log")
+        for op in ("read", "write", "verify"):
+            op_data = error_log.get(op)
+            if not isinstance(op_data, dict):
+                continue
+            for counter in _SCSI_ERROR_COUNTERS:
+                attrs[f"{op}_{counter}"] = op_data.get(counter, 0)
+            try:
+                attrs[f"{op}_gigabytes_processed"] = float(op_data.get("gigabytes_processed", "0"))
+            except (TypeError, ValueError):
+                logger.warning(f"Could not parse {op} gigabytes processed for {serial}: {op_data['gigabytes_processed']}")
+
+        # Pending Defects
+        pending_defects = _json_section(data, "scsi_pending_defects").get("count")
+        if pending_defects is not None:
+            attrs["pending_defects_count"] = pending_defects
+
+        # Self-Test Results
+        for n in (0, 1):
+            test = data.get(f"scsi_self_test_{n}")
+            if not isinstance(test, dict):
+                continue
+            result = _json_section(test, "result").get("value")
+            if result is not None:
+                attrs[f"self_test_{n}_result"] = result
+            test_hours = _json_section(test, "power_on_time").get("hours")
+            if test_hours is not None:
+                attrs[f"self_test_{n}_power_on_time"] = test_hours
+
+        # Extended Self-Test Duration
+        if "scsi_extended_self_test_seconds" in data:
+            attrs["extended_self_test_seconds"] = data["scsi_extended_self_test_seconds"]
+
+        # SMART Status
+        smart_status = _json_section(data, "smart_status")
+        if "passed" in smart_status:
+            attrs["smart_status_passed"] = 1 if smart_status["passed"] else 0
+
+        logger.debug("Parsed SCSI SMART data: %s, Serial: %s", attrs, serial)
         return attrs, serial
 
     def discover_scsi_nvme_devices(self) -> list[tuple[str, str, str, str]]:
         logger.debug("Entering discover_scsi_nvme_devices.")
         detected = []
         try:
-            out = self.run_remote_cmd("smartctl --scan-open")
-            logger.debug(f"smartctl --scan-open output: {out.strip()}")
+            out = self._ssh("smartctl --scan-open").decode(errors="replace")
+            logger.debug("smartctl --scan-open output: %s", out.strip())
             for line in out.strip().splitlines():
                 if line.startswith("#") or "open failed" in line.lower():
-                    logger.debug(f"Skipping line: '{line}'")
+                    logger.debug("Skipping line: '%s'", line)
                     continue
-                match = re.match(r'(/dev/\S+)\s+(-d\s+\S+(?:,\d+)?)\s*(?:#.*?\[(\S+)\])?', line)
-                if match:
+                # The usual "/dev/X -d TYPE[,N] # ... [id], ..." shape splits cleanly;
+                # anything else goes through the regex.
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[0].startswith("/dev/") and line.startswith(f"{parts[0]} -d {parts[2]}"):
+                    dev_path, d_arg = parts[0], f"-d {parts[2]}"
+                    comment = parts[3] if len(parts) > 3 else ""
+                    id_match = _SCAN_ID_RE.search(comment) if comment.startswith("#") else None
+                    disk_id = id_match.group(1) if id_match else ""
+                else:
+                    match = _SCAN_LINE_RE.match(line)
+                    if not match:
+                        continue
                     dev_path, d_arg, disk_id = match.groups()
-                    disk_id = disk_id or d_arg.replace("-d ", "").replace(",", "_")
-                    smartctl_cmd = f"smartctl -a -j {dev_path} {d_arg}"
-                    if "-d nvme" in d_arg.lower():
-                        detected.append(("nvme", dev_path, smartctl_cmd, disk_id))
-                    elif "-d scsi" in d_arg.lower() or "-d megaraid" in d_arg.lower() or "-d sat+megaraid" in d_arg.lower():
-                        detected.append(("scsi", dev_path, smartctl_cmd, disk_id))
-                    else:
-                        logger.debug(f"Skipping unhandled device: {dev_path} with -d '{d_arg}'")
+                disk_id = disk_id or d_arg.replace("-d ", "").replace(",", "_")
+                smartctl_cmd = f"smartctl -a -j {dev_path} {d_arg}"
+                dtype = _DEVICE_TYPES.get(d_arg[2:].strip().split(",", 1)[0].lower())
+                if dtype is None:
+                    logger.debug("Skipping unhandled device: %s with -d '%s'", dev_path, d_arg)
+                    continue
+                detected.append((dtype, dev_path, smartctl_cmd, disk_id))
         except Exception as e:
             logger.error(f"Error discovering devices: {e}", exc_info=True)
-        logger.debug(f"Discovered devices: {detected}")
+        logger.debug("Discovered devices: %s", detected)
         return detected
 
-    def main(self) -> str:
-        try:
-            data = self.get_perccli_json("/cALL show all J")
-        except RuntimeError as e:
-            logger.error(f"Failed to get perccli data: {e}")
-            raise
-        controllers = data.get("Controllers", [])
-        logger.debug(f"Found {len(controllers)} controllers.")
-        perccli_devices = set()
-        for controller in controllers:
-            response = controller.get("Response Data", {})
-            controller_index = response.get("Basics", {}).get("Controller", "Unknown")
-            logger.debug(f"Processing controller index: {controller_index}")
-            self.handle_common_controller(response)
-            driver_name = response.get("Version", {}).get("Driver Name", "Unknown")
-            logger.debug(f"Controller {controller_index} driver name: {driver_name}")
-            if driver_name in ["megaraid_sas", "lsi-mr3"]:
-                self.handle_megaraid_controller(response)
-                for pd in response.get("PD LIST", []):
-                    enclosure, slot = pd.get("EID:Slt", "0:0").split(":")[:2]
-                    perccli_devices.add(f"/c{controller_index}/e{enclosure}/s{slot}")
-                    logger.debug(f"Added perccli device to set: /c{controller_index}/e{enclosure}/s{slot}")
+    def main(self) -> bytes:
+        # Instances are reused across scrapes, so drop last scrape's label sets
+        # (e.g. removed drives) and keep concurrent scrapes of one target apart.
+        with self._lock:
+            if self._last_output is not None and time.monotonic() - self._last_output[0] < _SCRAPE_TTL:
+                logger.debug("Serving cached metrics for host %s.", self.host)
+                return self._last_output[1]
+            self._seen_children = set()
+            self.smart.clear()
+            self._collect()
+            for gauge, labelvalues in self._children.keys() - self._seen_children:
+                gauge.remove(*labelvalues)
+                del self._children[(gauge, labelvalues)]
+            output = generate_latest(self.registry)
+            self._last_output = (time.monotonic(), output)
+            return output
+
+    def _child(self, gauge: Gauge, *labelvalues) -> Gauge:
+        key = (gauge, labelvalues)
+        self._seen_children.add(key)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = gauge.labels(*labelvalues)
+        return child
+
+    def _collect(self) -> None:
+        # The smartctl side does not depend on the controller data, so its SSH
+        # round-trips overlap with perccli's instead of following them.
+        with ThreadPoolExecutor(max_workers=1) as extra_executor:
+            extra_devices = extra_executor.submit(self._collect_extra_devices)
+            try:
+                data = self.get_perccli_json(["/cALL", "show", "all", "J"])
+            except RuntimeError as e:
+                logger.error(f"Failed to get perccli data: {e}")
+                raise
+            controllers = data.get("Controllers", [])
+            logger.debug("Found %s controllers.", len(controllers))
+            # Controllers are independent, each with its own SSH traffic for SMART data.
+            with ThreadPoolExecutor(max_workers=max(1, len(controllers))) as executor:
+                list(executor.map(self._process_controller, controllers))
+            extra_devices.result()
+
+    def _collect_extra_devices(self) -> None:
         logger.debug("Discovering extra SCSI/NVMe devices.")
         extra_devs = self.discover_scsi_nvme_devices()
+        parsers = {"nvme": self.parse_smartctl_nvme, "scsi": self.parse_smartctl_scsi}
+        handled_devs = []
         for dtype, dev_path, smartctl_cmd, disk_id in extra_devs:
-            logger.debug(f"Processing extra device: {dev_path} of type {dtype} with smartctl cmd: '{smartctl_cmd}' and ID: {disk_id}")
-            if dtype == "nvme":
-                attrs, serial = self.parse_smartctl_nvme(smartctl_cmd)
-            elif dtype == "scsi":
-                attrs, serial = self.parse_smartctl_scsi(smartctl_cmd)
-            else:
+            logger.debug("Processing extra device: %s of type %s with smartctl cmd: '%s' and ID: %s", dev_path, dtype, smartctl_cmd, disk_id)
+            if dtype not in parsers:
                 logger.warning(f"Skipping unhandled device type: {dtype} for {dev_path}")
                 continue
+            handled_devs.append((dtype, dev_path, smartctl_cmd, disk_id))
+        # All smartctl calls share one SSH round-trip.
+        if not handled_devs:
+            return
+        try:
+            outputs = self.get_smartctl_batch([smartctl_cmd for _, _, smartctl_cmd, _ in handled_devs])
+        except RuntimeError as e:
+            logger.error(f"Failed to get smartctl data: {e}")
+            return
+        for (dtype, dev_path, _, disk_id), out in zip(handled_devs, outputs):
+            if out is None:
+                continue
+            # One device with unexpected output must not fail the whole scrape.
+            try:
+                attrs, serial = parsers[dtype](out)
+            except Exception as e:
+                logger.error(f"Error processing smartctl output for {dev_path}: {e}", exc_info=True)
+                continue
             drive_label = disk_id if dtype == "scsi" else dev_path
             for k, v in attrs.items():
-                self.metrics["drive_smart"].labels(controller="none", drive=drive_label, attribute=k).set(v)
-        latest_metrics = generate_latest(self.registry).decode()
-        return latest_metrics
+                self.smart.add(k, "none", drive_label, v)
 
-    def handle_common_controller(self, response: dict) -> None:
+    def _process_controller(self, controller: dict) -> None:
+        response = controller.get("Response Data", {})
         controller_index = response.get("Basics", {}).get("Controller", "Unknown")
-        model = response.get("Basics", {}).get("Model", "Unknown")
-        serial = response.get("Basics", {}).get("Serial Number", "Unknown")
-        fwversion = response.get("Version", {}).get("Firmware Version", "Unknown")
-        self.metrics["controller_info"].labels(
-            controller=controller_index,
-            model=model,
-            serial=serial,
-            fwversion=fwversion
-        ).set(1)
-        status = 1 if response.get("Status", {}).get("Controller Status") == "Optimal" else 0
-        self.metrics["controller_status"].labels(controller=controller_index).set(status)
-        for key in ["ROC temperature(Degree Celcius)", "ROC temperature(Degree Celsius)"]:
-            if key in response.get("HwCfg", {}):
-                temp = response["HwCfg"][key]
-                self.metrics["controller_temperature"].labels(controller=controller_index).set(temp)
-                break
+        logger.debug("Processing controller index: %s", controller_index)
+        self.handle_common_controller(response)
+        driver_name = response.get("Version", {}).get("Driver Name", "Unknown")
+        logger.debug("Controller %s driver name: %s", controller_index, driver_name)
+        handler = _DRIVER_HANDLERS.get(driver_name)
+        if handler is None:
+            if driver_name not in self._skipped_drivers:
+                logger.info(f"No drive-level collection for controller driver '{driver_name}'; exporting controller metrics only.")
+                self._skipped_drivers.add(driver_name)
+            return
+        handler(self, response)
+
+    def handle_common_controller(self, response: dict) -> None:
+        basics = response.get("Basics") or {}
+        hwcfg = response.get("HwCfg") or {}
+        controller_index = basics.get("Controller", "Unknown")
+        model = basics.get("Model", "Unknown")
+        serial = basics.get("Serial Number", "Unknown")
+        fwversion = (response.get("Version") or {}).get("Firmware Version", "Unknown")
+        # Swept like the other children, so a firmware update or a removed
+        # controller drops the old info series.
+        self._child(self.controller_info, controller_index, model, serial, fwversion).set(1)
+        status = 1 if (response.get("Status") or {}).get("Controller Status") == "Optimal" else 0
+        self._child(self.controller_status, controller_index).set(status)
+        # perccli spells it "Celcius" on some firmware versions.
+        temp = hwcfg.get("ROC temperature(Degree Celcius)")
+        if temp is None:
+            temp = hwcfg.get("ROC temperature(Degree Celsius)")
+        if temp is not None:
+            self._child(self.controller_temperature, controller_index).set(temp)
 
     def handle_megaraid_controller(self, response: dict) -> None:
-        controller_index = response.get("Basics", {}).get("Controller", "Unknown")
+        controller_index = (response.get("Basics") or {}).get("Controller", "Unknown")
+        drives = []
         for drive in response.get("PD LIST", []):
-            enclosure, slot = drive.get("EID:Slt", "0:0").split(":")[:2]
-            drive_path = f"/c{controller_index}/e{enclosure}/s{slot}"
-            logger.debug(f"Processing physical drive: {drive_path}")
-            smart_data = self.get_perccli_smart(drive_path)
+            enclosure, slot = drive.get("EID:Slt", "0:0").split(":", 1)
+            drives.append((drive, f"/c{controller_index}/e{enclosure}/s{slot}"))
+        smart_by_path = self.get_perccli_smart_batch([drive_path for _, drive_path in drives]) if drives else {}
+        for drive, drive_path in drives:
+            logger.debug("Processing physical drive: %s", drive_path)
+            smart_data = smart_by_path.get(drive_path, "")
+            if not smart_data:
+                logger.warning(f"No SMART data found for {drive_path}")
             smart_attributes = self.parse_smart_data(smart_data)
-            self.create_metrics_of_physical_drive(drive, [], controller_index, smart_attributes)
+            self.create_metrics_of_physical_drive(drive, controller_index, f"Drive {drive_path}", smart_attributes)
         for vd in response.get("VD LIST", []):
-            vd_position = vd.get("DG/VD", "0/0")
-            drive_group, volume_group = vd_position.split("/")[:2]
+            drive_group, volume_group = vd.get("DG/VD", "0/0").split("/", 1)
             vd_id = f"DG{drive_group}/VD{volume_group}"
             status = 1 if vd.get("State", "Unknown") == "Optl" else 0
-            self.metrics["virtual_drive_status"].labels(controller=controller_index, vd=vd_id).set(status)
-        bbu_status = response.get("Status", {}).get("BBU Status", "NA")
+            self._child(self.virtual_drive_status, controller_index, vd_id).set(status)
+        bbu_status = (response.get("Status") or {}).get("BBU Status", "NA")
         if bbu_status != "NA":
             bbu_health = 1 if bbu_status in [0, 8, 4096] else 0
-            self.metrics["bbu_health"].labels(controller=controller_index).set(bbu_health)
+            self._child(self.bbu_health, controller_index).set(bbu_health)
 
-    def create_metrics_of_physical_drive(self, physical_drive: dict, detailed_info_array: list, controller_index: str, smart_attributes: dict) -> None:
-        enclosure, slot = physical_drive.get("EID:Slt", "0:0").split(":")[:2]
-        drive_identifier = f"Drive /c{controller_index}/e{enclosure}/s{slot}"
+    def create_metrics_of_physical_drive(self, physical_drive: dict, controller_index: str, drive_identifier: str, smart_attributes: dict[str, int]) -> None:
         state = physical_drive.get("State", "Unknown")
         status = 1 if state == "Onln" else 0
-        self.metrics["drive_status"].labels(controller=controller_index, drive=drive_identifier).set(status)
+        self._child(self.drive_status, controller_index, drive_identifier).set(status)
         if "Temp" in physical_drive:
             try:
                 temp = int(physical_drive["Temp"].replace("C", ""))
-                self.metrics["drive_temp"].labels(controller=controller_index, drive=drive_identifier).set(temp)
+                self._child(self.drive_temp, controller_index, drive_identifier).set(temp)
             except ValueError:
                 logger.warning(f"Could not parse temperature for {drive_identifier}: {physical_drive['Temp']}")
         for attr, value in smart_attributes.items():
-            self.metrics["drive_smart"].labels(controller=controller_index, drive=drive_identifier, attribute=attr).set(value)
-
-    def get_perccli_json(self, perccli_args: str) -> dict:
-        logger.debug(f"Entering get_perccli_json with args: {perccli_args}")
+            self.smart.add(attr, controller_index, drive_identifier, value)
+
+    def get_perccli_json(self, perccli_args: list[str]) -> dict:
+        logger.debug("Entering get_perccli_json with args: %s", perccli_args)
+        key = (self.host, tuple(perccli_args))
+        with _PERCCLI_CACHE_LOCK:
+            cached = _PERCCLI_CACHE.get(key)
+        if cached and time.monotonic() - cached[0] < _PERCCLI_TTL:
+            logger.debug("Using cached perccli output for %s", perccli_args)
+            return cached[1]
         result = self._run_perccli_command(perccli_args)
+        with _PERCCLI_CACHE_LOCK:
+            _PERCCLI_CACHE[key] = (time.monotonic(), result)
         return result
 
-    def get_perccli_smart(self, drive_path: str) -> str:
-        logger.debug(f"Entering get_perccli_smart for drive: {drive_path}")
-        cmd = f"{drive_path} show smart"
-        output = self._run_perccli_command(cmd, expect_json=False)
-        match = re.search(r'Smart Data Info .*? = \n([0-9a-fA-F \n]+)', output, re.DOTALL)
-        smart_data = match.group(1).replace('\n', '').strip() if match else ""
-        if not smart_data:
-            logger.warning(f"No SMART data found for {drive_path}")
+    def get_perccli_smart_batch(self, drive_paths: list[str]) -> dict[str, str]:
+        logger.debug("Entering get_perccli_smart_batch for drives: %s", drive_paths)
+        now = time.monotonic()
+        smart_by_path = {}
+        stale_paths = []
+        for drive_path in drive_paths:
+            cached = _SMART_CACHE.get((self.host, drive_path))
+            if cached and now - cached[0] < _SMART_TTL:
+                smart_by_path[drive_path] = cached[1]
+            else:
+                stale_paths.append(drive_path)
+        if not stale_paths:
+            logger.debug("Using cached SMART data for all %s drives", len(drive_paths))
+            return smart_by_path
+        commands = [[drive_path, "show", "smart"] for drive_path in stale_paths]
+        output = self._run_perccli_command(commands, expect_json=False)
+        # In batch mode every command's output is terminated by the sentinel line,
+        # so sections line up with stale_paths regardless of what perccli printed.
+        sections = output.split(f"{_BATCH_SENTINEL}\n")
+        fetched = {}
+        for drive_path, section in zip(stale_paths, sections):
+            match = _SMART_BLOCK_RE.search(section)
+            fetched[drive_path] = match.group(1).translate(_WS_TABLE) if match else ""
+            logger.debug("Extracted SMART data length for %s: %s", drive_path, len(fetched[drive_path]))
+        for drive_path in stale_paths[len(sections):]:
+            fetched[drive_path] = ""
+        for drive_path, smart_data in fetched.items():
+            _SMART_CACHE[(self.host, drive_path)] = (now, smart_data)
+        smart_by_path.update(fetched)
+        return smart_by_path
+
+    def _run_perccli_command(self, perccli_args: list[str] | list[list[str]], expect_json: bool = True) -> dict | str:
+        logger.debug("Entering _run_perccli_command with args: %s, expect_json: %s", perccli_args, expect_json)
+        # A list of argument lists runs several perccli invocations in one SSH
+        # session, each followed by a _BATCH_SENTINEL line.
+        if perccli_args and isinstance(perccli_args[0], list):
+            # A failed cd must fail the whole session: the trailing echo would
+            # otherwise leave the exit status at 0.
+            remote_cmd = "cd /opt/lsi/perccli/ || exit 1; " + "; ".join(f"{shlex.join(['./perccli64', *args])}; echo {_BATCH_SENTINEL}" for args in perccli_args)
         else:
-            logger.debug(f"Extracted SMART data length for {drive_path}: {len(smart_data)}")
-        return smart_data
-
-    def _run_perccli_command(self, perccli_args: str, expect_json: bool = True) -> dict | str:
-        logger.debug(f"Entering _run_perccli_command with args: {perccli_args}, expect_json: {expect_json}")
-        safe_args = shlex.quote(perccli_args)
-        cmd = f"ssh -i /root/.ssh/id_rsa_exporter -p 22 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null {shlex.quote(self.username)}@{shlex.quote(self.host)} 'cd /opt/lsi/perccli/ && ./perccli64 {safe_args}'"
-        logger.debug(f"Executing command: {cmd}")
+            remote_cmd = f"cd /opt/lsi/perccli/ && {shlex.join(['./perccli64', *perccli_args])}"
+        stdout = self._ssh(remote_cmd)
+        if expect_json:
+            try:
+                return _json.loads(stdout)
+            except _json.JSONDecodeError as e:
+                logger.error(f"Failed to decode JSON from perccli output: {e}. Output: {stdout[:500]!r}...")
+                raise RuntimeError(f"Invalid JSON output from perccli: {e}") from e
+        return stdout.decode(errors="replace")
+
+    def close(self) -> None:
+        # "stop" rather than "exit": the control socket is shared with other
+        # processes (e.g. gunicorn workers), so let in-flight sessions finish.
+        cmd = ["ssh", *_SSH_MUX_OPTS, "-O", "stop", f"{self.username}@{self.host}"]
+        logger.debug("Stopping SSH master connection: %s", shlex.join(cmd))
         try:
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stdout, stderr = proc.communicate()
-            if proc.returncode != 0:
-                logger.error(f"perccli command failed with return code {proc.returncode}: {stderr}")
-                raise RuntimeError(f"perccli failed: {stderr}")
-            if expect_json:
-                try:
-                    parsed_json = json.loads(stdout)
-                    return parsed_json
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to decode JSON from perccli output: {e}. Output: {stdout[:500]}...")
-                    raise RuntimeError(f"Invalid JSON output from perccli: {e}")
-            return stdout
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            stdout, stderr = proc.communicate()
-            logger.error(f"perccli command timed out after 30 seconds. Stderr: {stderr}")
-            raise RuntimeError(f"perccli command timed out: {stderr}")
-        except Exception as e:
-            logger.error(f"Error executing perccli command: {e}", exc_info=True)
-            raise
-
-    def run_remote_cmd(self, command: str) -> str:
-        logger.debug(f"Entering run_remote_cmd with command: {command}")
-        cmd = f"ssh -i /root/.ssh/id_rsa_exporter -p 22 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null root@103.90.225.9 {shlex.quote(command)}"
-        logger.debug(f"Executing remote command: {cmd}")
+            subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, timeout=10, check=False)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Failed to stop SSH master connection for {self.host}: {e}")
+
+    def get_smartctl_batch(self, smartctl_cmds: list[str]) -> list[bytes | None]:
+        # Runs every command in one SSH session; each output is followed by the
+        # sentinel and the command's exit status. Commands that failed fatally (or
+        # whose section is missing) yield None.
+        remote_cmd = "; ".join(f"{smartctl_cmd}; echo {_BATCH_SENTINEL} $?" for smartctl_cmd in smartctl_cmds)
+        # Alternating output, status, output, status, ... and whatever trails the last sentinel.
+        parts = _SMARTCTL_STATUS_RE.split(self._ssh(remote_cmd))
+        outputs: list[bytes | None] = []
+        for i, smartctl_cmd in enumerate(smartctl_cmds):
+            if 2 * i + 1 >= len(parts):
+                logger.error(f"No smartctl output for '{smartctl_cmd}'")
+                outputs.append(None)
+                continue
+            status = int(parts[2 * i + 1])
+            if status & _SMARTCTL_FATAL_BITS:
+                logger.error(f"smartctl command '{smartctl_cmd}' failed with exit status {status}")
+                outputs.append(None)
+                continue
+            outputs.append(parts[2 * i])
+        return outputs
+
+    def _ssh(self, remote_cmd: str) -> bytes:
+        # Every remote command (perccli and smartctl) goes through here, over the
+        # multiplexed connection to this instance's host.
+        cmd = [*self._ssh_prefix, remote_cmd]
+        logger.debug("Executing remote command: %s", shlex.join(cmd))
         try:
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stdout, stderr = proc.communicate()
-            if proc.returncode != 0:
-                logger.error(f"SSH command failed with return code {proc.returncode}: {stderr}")
-                raise RuntimeError(f"SSH command failed: {stderr}")
-            return stdout
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            stdout, stderr = proc.communicate()
-            logger.error(f"SSH command timed out after 30 seconds. Stderr: {stderr}")
-            raise RuntimeError(f"SSH command timed out: {stderr}")
-        except Exception as e:
-            logger.error(f"Error executing remote command: {e}", exc_info=True)
-            raise
+            # stdout stays bytes for the JSON parser; only stderr is decoded, for messages.
+            proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, timeout=_SSH_TIMEOUT, check=False)
+        except subprocess.TimeoutExpired as e:
+            logger.error(f"SSH command timed out after {_SSH_TIMEOUT} seconds. Stderr: {e.stderr}")
+            raise RuntimeError(f"SSH command timed out after {_SSH_TIMEOUT} seconds") from e
+        if proc.returncode != 0:
+            stderr = proc.stderr.decode(errors="replace")
+            logger.error(f"SSH command failed with return code {proc.returncode}: {stderr}")
+            raise RuntimeError(f"SSH command failed: {stderr}")
+        return proc.stdout
+
+# Drive-level collection per controller driver; other drivers only get the
+# common controller metrics.
+_DRIVER_HANDLERS = {
+    "megaraid_sas": PercMetrics.handle_megaraid_controller,
+    "lsi-mr3": PercMetrics.handle_megaraid_controller,
+}
+
+# One collector (and CollectorRegistry) per target, reused for every scrape.
+_METRICS_BY_TARGET: dict[str, PercMetrics] = {}
+_METRICS_BY_TARGET_LOCK = threading.Lock()
+def _close_collectors() -> None:
+    for metrics_collector in _METRICS_BY_TARGET.values():
+        metrics_collector.close()
+
+atexit.register(_close_collectors)
+
+# Configured target names, filled in once the configuration is loaded.
+_TARGETS: frozenset[str] = frozenset()
+
+# Static bodies for rejected requests, so bad probes cost no formatting work.
+_MISSING_TARGET_BODY = b"Parameter 'target' is missing."
+_INVALID_TARGET_BODY = b"Invalid target."
+_UNKNOWN_PARAM_BODY = b"Only the 'target' parameter is supported."
 
 @app.route("/metrics")
 def metrics_route():
     logger.debug("Received request for /metrics.")
+    if any(param != "target" for param in request.args):
+        logger.warning("Unsupported query parameters in /metrics request.")
+        return Response(_UNKNOWN_PARAM_BODY, status=400, mimetype="text/plain")
     target = request.args.get("target")
     if not target:
         logger.warning("No target specified in /metrics request.")
-        return Response("Parameter 'target' is missing.", status=400, mimetype="text/plain")
-    if target not in config["targets"]:
+        return Response(_MISSING_TARGET_BODY, status=400, mimetype="text/plain")
+    if target not in _TARGETS:
         logger.warning(f"Invalid target '{target}' requested.")
-        return Response(f"Invalid target '{target}'", status=400, mimetype="text/plain")
-    
+        return Response(_INVALID_TARGET_BODY, status=400, mimetype="text/plain")
+
     tcfg = config["targets"][target]
-    logger.debug(f"Processing metrics for target: {target}")
+    logger.debug("Processing metrics for target: %s", target)
     try:
-        metrics_collector = PercMetrics(tcfg["username"], tcfg["password"], target)
+        metrics_collector = _METRICS_BY_TARGET.get(target)
+        if metrics_collector is None:
+            with _METRICS_BY_TARGET_LOCK:
+                metrics_collector = _METRICS_BY_TARGET.get(target)
+                if metrics_collector is None:
+                    metrics_collector = _METRICS_BY_TARGET[target] = PercMetrics(tcfg["username"], tcfg["password"], target)
         metrics = metrics_collector.main()
-        logger.debug(f"Successfully generated metrics for target {target}.")
-        return Response(metrics, mimetype="text/plain; version=0.0.4")
+        logger.debug("Successfully generated metrics for target %s.", target)
+        # The body depends on Accept-Encoding, so caches must key on it either way.
+        if request.accept_encodings["gzip"]:
+            return Response(gzip.compress(metrics), headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}, content_type=CONTENT_TYPE_LATEST)
+        return Response(metrics, headers={"Vary": "Accept-Encoding"}, content_type=CONTENT_TYPE_LATEST)
     except RuntimeError as e:
         logger.error(f"Error generating metrics for target {target}: {e}")
         return Response(f"Error generating metrics for target {target}: {e}", status=500, mimetype="text/plain")
@@ -474,8 +723,7 @@ def metrics_route():
 def load_config(path: str) -> dict:
     try:
         with open(path, "r") as f:
-            cfg = yaml.safe_load(f)
-            return cfg
+            return yaml.load(f, Loader=_YAML_LOADER)
     except FileNotFoundError:
         logger.critical(f"Configuration file not found at {path}")
         raise
@@ -483,14 +731,20 @@ def load_config(path: str) -> dict:
         logger.critical(f"Error parsing YAML configuration file: {e}")
         raise
 
+def init_config(path: str) -> None:
+    global config, _TARGETS
+    config = load_config(path)
+    _TARGETS = frozenset(config["targets"])
+
 if __name__ == "__main__":
     config_path = os.environ.get("CONFIG_FILE_PATH", "config.yml")
     try:
-        config = load_config(config_path)
+        init_config(config_path)
     except Exception as e:
         logger.critical(f"Failed to load configuration, exiting: {e}")
         exit(1)
     
     port = int(os.environ.get("PORT", 10424))
-    logger.debug(f"Application configured to run on host 0.0.0.0 and port {port}.")
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    logger.debug("Application configured to run on host 0.0.0.0 and port %s.", port)
+    # Development server only; use wsgi.py with gunicorn in production.
+    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False, threaded=True)
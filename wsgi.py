@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+import os
+from main import app, init_config
+
+init_config(os.environ.get("CONFIG_FILE_PATH", "config.yml"))
+application = app